@@ -2,8 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import functools
+import re
 import socket
-from typing import List
+from typing import Iterable, Iterator, List, Sequence
 
 # ASTM control characters
 ENQ = 0x05
@@ -15,89 +17,241 @@ ETX = 0x03
 CR = 0x0D
 LF = 0x0A
 
+SOCK_BUF_SIZE = 262144  # SO_RCVBUF / SO_SNDBUF
+
+# LF or CRLF record separators, normalized to CR
+_NEWLINE_RE = re.compile(r"\r?\n")
+
+
+_CTRL_MAP = {
+    ENQ: "ENQ",
+    ACK: "ACK",
+    NAK: "NAK",
+    EOT: "EOT",
+    STX: "STX",
+    ETX: "ETX",
+    CR: "CR",
+    LF: "LF",
+}
+
+# Debug representation of every byte value, computed once
+_PRINTABLE_TBL = [
+    f"'{chr(v)}'" if 32 <= v <= 126 else _CTRL_MAP.get(v, f"0x{v:02X}")
+    for v in range(256)
+]
+
 
 def printable(byte_val: int) -> str:
     """Return a human readable representation for debug."""
-    if 32 <= byte_val <= 126:
-        return f"'{chr(byte_val)}'"
-    mapping = {
-        ENQ: "ENQ",
-        ACK: "ACK",
-        NAK: "NAK",
-        EOT: "EOT",
-        STX: "STX",
-        ETX: "ETX",
-        CR: "CR",
-        LF: "LF",
-    }
-    return mapping.get(byte_val, f"0x{byte_val:02X}")
-
-
-def build_frames(astm_message: str) -> List[bytes]:
+    return _PRINTABLE_TBL[byte_val]
+
+
+class FramedReader:
+    """
+    Buffered reader on top of a socket.
+    One large recv() refills an in-memory buffer; single bytes, fixed-size
+    trailers and delimited frame bodies are then served from that buffer.
     """
-    Build ASTM E1381 frames for a logical ASTM message.
+
+    def __init__(self, sock: socket.socket, bufsize: int = 4096):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.buf = bytearray()
+        self.pos = 0
+        # preallocated landing zone for recv_into(), reused by every refill
+        self._chunk = memoryview(bytearray(bufsize))
+
+    def _fill(self) -> bool:
+        """Append more data from the socket to the buffer. Returns False on EOF."""
+        k = self.sock.recv_into(self._chunk)
+        if not k:
+            return False
+        if self.pos:
+            # drop already consumed bytes before growing the buffer
+            del self.buf[:self.pos]
+            self.pos = 0
+        self.buf += self._chunk[:k]
+        return True
+
+    def read_byte(self) -> int:
+        """Return the next byte value, or -1 if the peer closed the connection."""
+        if self.pos >= len(self.buf) and not self._fill():
+            return -1
+        byte = self.buf[self.pos]
+        self.pos += 1
+        return byte
+
+    def read_exact(self, n: int) -> bytes:
+        """Read n bytes (fewer only if the peer closed the connection)."""
+        while len(self.buf) - self.pos < n:
+            if not self._fill():
+                break
+        with memoryview(self.buf) as view:
+            data = bytes(view[self.pos:self.pos + n])
+        self.pos += len(data)
+        return data
+
+    def read_until(self, stop_bytes: set, max_len: int = 8192) -> bytes:
+        """
+        Read bytes until one of stop bytes encountered or max_len exceeded.
+        Returns the data INCLUDING the stop byte.
+        """
+        scanned = 0  # bytes after pos already searched, not rescanned after a refill
+        while True:
+            limit = min(len(self.buf), self.pos + max_len)
+            hits = [i for i in (self.buf.find(s, self.pos + scanned, limit) for s in stop_bytes) if i >= 0]
+            if hits:
+                end = min(hits) + 1
+            elif limit - self.pos >= max_len:
+                end = limit
+            else:
+                scanned = limit - self.pos
+                if self._fill():
+                    continue
+                end = len(self.buf)
+            with memoryview(self.buf) as view:
+                data = bytes(view[self.pos:end])
+            self.pos = end
+            return data
+
+    def read_some(self, stop_bytes: set) -> bytes:
+        """
+        Return what is buffered (refilling once if the buffer is empty), up to
+        and INCLUDING the first stop byte. Returns b"" on EOF.
+        Unlike read_until, never waits for a stop byte, so callers can report
+        data as it arrives and the buffer never grows past one refill.
+        """
+        if self.pos >= len(self.buf) and not self._fill():
+            return b""
+        hits = [i for i in (self.buf.find(s, self.pos) for s in stop_bytes) if i >= 0]
+        end = min(hits) + 1 if hits else len(self.buf)
+        with memoryview(self.buf) as view:
+            data = bytes(view[self.pos:end])
+        self.pos = end
+        return data
+
+
+def split_records(astm_message: str) -> List[bytes]:
+    """
+    Split a logical ASTM message into its non-empty records, ASCII encoded.
 
     Input message must contain CR as record separator (H|, P|, O|, R|, L|...).
-    This mimics AnalyzerSysmex.sendASTMMessage().
+    LF and CRLF are accepted too; messages built by get_sysmex_*_message
+    are already CR-only and skip the normalization.
     """
-    msg_norm = astm_message.replace("\r\n", "\r").replace("\n", "\r")
-    lines = [line for line in msg_norm.split("\r") if line]
+    if "\n" in astm_message:
+        astm_message = _NEWLINE_RE.sub("\r", astm_message)
+    msg_b = astm_message.encode("ascii", errors="replace")
+    return [line for line in msg_b.split(b"\r") if line]
 
-    frames: List[bytes] = []
 
-    for idx, line in enumerate(lines):
+def build_frames(records: Sequence[bytes]) -> Iterator[bytes]:
+    """
+    Build ASTM E1381 frames for the records of a logical ASTM message.
+
+    records are the encoded lines returned by split_records(). Frames are
+    yielded one by one, each assembled only when the caller asks for it.
+    This mimics AnalyzerSysmex.sendASTMMessage().
+    """
+    for idx, line_b in enumerate(records):
         # Frame number cycles 1..7,0
         frame_no = (idx + 1) % 8
-        if frame_no == 0:
-            frame_char = b"0"
-        else:
-            frame_char = bytes([ord("0") + frame_no])
 
+        # Layout: STX frameNo <record line> CR ETX cksum(2) CR LF
         # Body = frameNo + record line + CR  <-- IMPORTANT
-        body = frame_char + line.encode("ascii", errors="replace") + b"\r"
+        n = len(line_b)
+        frame = bytearray(n + 8)
+        frame[0] = STX
+        frame[1] = ord("0") + frame_no
+        frame[2:2 + n] = line_b
+        frame[2 + n] = CR
+        frame[3 + n] = ETX
+
+        # checksum covers frameNo .. ETX (STX excluded)
+        checksum = sum(memoryview(frame)[1:4 + n]) & 0xFF
+        frame[4 + n:6 + n] = f"{checksum:02X}".encode("ascii")
+        frame[6 + n] = CR
+        frame[7 + n] = LF
+
+        yield bytes(frame)
+
+
+def send_frames_lockstep(
+    sock: socket.socket, reader: FramedReader, frames: Iterable[bytes], total: int, start: int = 1
+) -> None:
+    """
+    Send frames one at a time, waiting for the ACK of each before the next.
+    frames may be lazy; start is the number of the first one (out of total).
+    """
+    for i, frame in enumerate(frames, start=start):
+        print(f">>> Sending frame {i}/{total}")
+        sock.sendall(frame)
 
-        checksum = (sum(body) + ETX) & 0xFF
-        checksum_str = f"{checksum:02X}".encode("ascii")
+        r = reader.read_byte()
+        if r < 0:
+            raise RuntimeError(f"No response after frame {i}")
+        if r == ACK:
+            print(f"<<< Frame {i} ACK")
+        elif r == NAK:
+            raise RuntimeError(f"Frame {i} got NAK from plugin")
+        else:
+            raise RuntimeError(f"Frame {i} unexpected response: {printable(r)}")
 
-        frame = bytes([STX]) + body + bytes([ETX]) + checksum_str + bytes([CR, LF])
-        frames.append(frame)
 
-    return frames
+def send_frames_pipelined(sock: socket.socket, reader: FramedReader, frames: List[bytes]) -> None:
+    """
+    Send all frames back-to-back in one write, then drain one response per frame.
 
+    Receivers ACK frames in order. A NAK is an error, as in lockstep mode:
+    the later frames have already been accepted, so resending from the
+    NAKed one would duplicate records on the receiver.
+    """
+    print(f">>> Sending frames 1-{len(frames)} (pipelined)")
+    sock.sendall(b"".join(frames))
+
+    resps = reader.read_exact(len(frames))
+    for i, r in enumerate(resps, start=1):
+        if r == ACK:
+            print(f"<<< Frame {i} ACK")
+        elif r == NAK:
+            raise RuntimeError(f"Frame {i} got NAK from plugin")
+        else:
+            raise RuntimeError(f"Frame {i} unexpected response: {printable(r)}")
+
+    if len(resps) < len(frames):
+        raise RuntimeError(f"No response after frame {len(resps) + 1}")
+
+
+def send_astm_message(sock: socket.socket, reader: FramedReader, astm_message: str, pipeline: bool = False) -> None:
+    """
+    Send one ASTM message as analyzer (client) to the plugin.
+
+    With pipeline=True, frames are not sent in lockstep with their ACKs
+    (see send_frames_pipelined).
+    """
+    records = split_records(astm_message)
 
-def send_astm_message(sock: socket.socket, astm_message: str) -> None:
-    """Send one ASTM message as analyzer (client) to the plugin."""
     print(">>> Sending ENQ")
     sock.sendall(bytes([ENQ]))
 
-    resp = sock.recv(1)
-    if not resp:
+    resp = reader.read_byte()
+    if resp < 0:
         raise RuntimeError("No response after ENQ")
-    if resp[0] != ACK:
-        raise RuntimeError(f"Unexpected response after ENQ: {printable(resp[0])}")
+    if resp != ACK:
+        raise RuntimeError(f"Unexpected response after ENQ: {printable(resp)}")
     print("<<< Received ACK after ENQ")
 
-    frames = build_frames(astm_message)
-
-    for i, frame in enumerate(frames, start=1):
-        print(f">>> Sending frame {i}/{len(frames)}")
-        sock.sendall(frame)
-
-        r = sock.recv(1)
-        if not r:
-            raise RuntimeError(f"No response after frame {i}")
-        if r[0] == ACK:
-            print(f"<<< Frame {i} ACK")
-        elif r[0] == NAK:
-            raise RuntimeError(f"Frame {i} got NAK from plugin")
-        else:
-            raise RuntimeError(f"Frame {i} unexpected response: {printable(r[0])}")
+    frames = build_frames(records)
+    if pipeline:
+        send_frames_pipelined(sock, reader, list(frames))
+    else:
+        send_frames_lockstep(sock, reader, frames, len(records))
 
     print(">>> Sending EOT (end of message)")
     sock.sendall(bytes([EOT]))
 
 
-def receive_astm_from_plugin(sock: socket.socket) -> str:
+def receive_astm_from_plugin(sock: socket.socket, reader: FramedReader) -> str:
     """
     Receive ASTM response from plugin (host -> analyzer direction).
 
@@ -109,17 +263,18 @@ def receive_astm_from_plugin(sock: socket.socket) -> str:
     sock.settimeout(10.0)
 
     print("\n--- Waiting for response from plugin ---")
-    # Wait for ENQ
+    # Wait for ENQ: scan each refill for it; bytes before it are reported and ignored
     while True:
-        b = sock.recv(1)
-        if not b:
+        chunk = reader.read_some({ENQ})
+        if not chunk:
             print("Connection closed while waiting for ENQ")
             return ""
-        if b[0] == ENQ:
+        found = chunk[-1] == ENQ
+        for b in chunk[:-1] if found else chunk:
+            print("Ignoring byte while waiting for ENQ:", printable(b))
+        if found:
             print("<<< ENQ from plugin")
             break
-        else:
-            print("Ignoring byte while waiting for ENQ:", printable(b[0]))
 
     print(">>> Sending ACK for ENQ")
     sock.sendall(bytes([ACK]))
@@ -127,36 +282,31 @@ def receive_astm_from_plugin(sock: socket.socket) -> str:
     assembled = bytearray()
 
     while True:
-        b = sock.recv(1)
-        if not b:
+        b = reader.read_byte()
+        if b < 0:
             print("Connection closed while waiting for STX/EOT")
             return assembled.decode("ascii", errors="replace")
 
-        if b[0] == EOT:
+        if b == EOT:
             print("<<< EOT from plugin (response complete)")
             break
 
-        if b[0] != STX:
-            print("Unexpected byte while waiting for STX/EOT:", printable(b[0]))
+        if b != STX:
+            print("Unexpected byte while waiting for STX/EOT:", printable(b))
             continue
 
-        frame_no_b = sock.recv(1)
-        if not frame_no_b:
+        frame_no = reader.read_byte()
+        if frame_no < 0:
             raise RuntimeError("Stream closed after STX while reading frame number")
-        frame_no = frame_no_b[0]
         print(f"<<< STX, frame {chr(frame_no)}")
 
-        payload = bytearray()
-        while True:
-            c = sock.recv(1)
-            if not c:
-                raise RuntimeError("Stream closed while reading frame payload")
-            if c[0] == ETX:
-                break
-            payload.extend(c)
+        data = reader.read_until({ETX})
+        if not data or data[-1] != ETX:
+            raise RuntimeError("Stream closed or frame too long while reading frame payload")
+        payload = memoryview(data)[:-1]
 
-        chk = sock.recv(2)
-        trailer = sock.recv(2)
+        chk = reader.read_exact(2)
+        trailer = reader.read_exact(2)
         if len(chk) < 2 or len(trailer) < 2:
             raise RuntimeError("Incomplete frame trailer from plugin")
 
@@ -171,24 +321,42 @@ def receive_astm_from_plugin(sock: socket.socket) -> str:
     return msg
 
 
+# Static LAB-29 messages, built once at import time.
+# The RES template only varies by the specimen ID injected in the O-record.
+_RES_TEMPLATE = "\r".join([
+    "H|\\^&|||    XN-350^00-27^15735^^^^AW618382||||||||E1394-97",
+    "P|1",
+    "C|1||",
+    "O|1||^^{specimen}^A|^^^^WBC\\^^^^RBC\\^^^^HGB\\^^^^HCT\\^^^^PLT|||||||N||||||||||||||F",
+    "R|1|^^^^WBC^26|7.4|10^3/uL||N|||OP1||20251205133500",
+    "R|2|^^^^RBC^27|4.45|10^6/uL||N|||OP1||20251205133500",
+    "R|3|^^^^HGB^28|13.2|g/dL||N|||OP1||20251205133500",
+    "R|4|^^^^HCT^29|40.1|%||N|||OP1||20251205133500",
+    "R|5|^^^^PLT^30|250|10^3/uL||N|||OP1||20251205133500",
+    "L|1|N",
+]) + "\r"
+
+_BG_CHECK_MSG = "\r".join([
+    "H|\\^&|||    XN-350^00-27^15735^^^^AW618382||||||||E1394-97",
+    "P|1",
+    "C|1||",
+    "O|1||^^BACKGROUNDCHECK^A|^^^^WBC\\^^^^RBC\\^^^^HGB\\^^^^HCT\\^^^^PLT|||||||Q||||||||||||||F",
+    "R|1|^^^^WBC^26|7.0|10^3/uL||N|||QC1||20251205120400",
+    "R|2|^^^^RBC^27|4.50|10^6/uL||N|||QC1||20251205120400",
+    "R|3|^^^^HGB^28|13.0|g/dL||N|||QC1||20251205120400",
+    "R|4|^^^^HCT^29|39.8|%||N|||QC1||20251205120400",
+    "R|5|^^^^PLT^30|240|10^3/uL||N|||QC1||20251205120400",
+    "L|1|N",
+]) + "\r"
+
+
+@functools.lru_cache(maxsize=1024)
 def get_sysmex_result_message(specimen: str) -> str:
     """
     Build a minimal but realistic Sysmex LAB-29 patient result message.
     Specimen ID is injected in the O-record.
     """
-    segments = [
-        "H|\\^&|||    XN-350^00-27^15735^^^^AW618382||||||||E1394-97",
-        "P|1",
-        "C|1||",
-        f"O|1||^^{specimen}^A|^^^^WBC\\^^^^RBC\\^^^^HGB\\^^^^HCT\\^^^^PLT|||||||N||||||||||||||F",
-        "R|1|^^^^WBC^26|7.4|10^3/uL||N|||OP1||20251205133500",
-        "R|2|^^^^RBC^27|4.45|10^6/uL||N|||OP1||20251205133500",
-        "R|3|^^^^HGB^28|13.2|g/dL||N|||OP1||20251205133500",
-        "R|4|^^^^HCT^29|40.1|%||N|||OP1||20251205133500",
-        "R|5|^^^^PLT^30|250|10^3/uL||N|||OP1||20251205133500",
-        "L|1|N",
-    ]
-    return "\r".join(segments) + "\r"
+    return _RES_TEMPLATE.format(specimen=specimen)
 
 
 def get_sysmex_background_check_message() -> str:
@@ -198,19 +366,7 @@ def get_sysmex_background_check_message() -> str:
     Specimen ID is BACKGROUNDCHECK so that AnalyzerSysmex
     detects it and does not send HL7 upstream.
     """
-    segments = [
-        "H|\\^&|||    XN-350^00-27^15735^^^^AW618382||||||||E1394-97",
-        "P|1",
-        "C|1||",
-        "O|1||^^BACKGROUNDCHECK^A|^^^^WBC\\^^^^RBC\\^^^^HGB\\^^^^HCT\\^^^^PLT|||||||Q||||||||||||||F",
-        "R|1|^^^^WBC^26|7.0|10^3/uL||N|||QC1||20251205120400",
-        "R|2|^^^^RBC^27|4.50|10^6/uL||N|||QC1||20251205120400",
-        "R|3|^^^^HGB^28|13.0|g/dL||N|||QC1||20251205120400",
-        "R|4|^^^^HCT^29|39.8|%||N|||QC1||20251205120400",
-        "R|5|^^^^PLT^30|240|10^3/uL||N|||QC1||20251205120400",
-        "L|1|N",
-    ]
-    return "\r".join(segments) + "\r"
+    return _BG_CHECK_MSG
 
 
 def build_message(msg_type: str, specimen: str) -> str:
@@ -227,6 +383,28 @@ def build_message(msg_type: str, specimen: str) -> str:
     raise ValueError(f"Unsupported message type: {msg_type}")
 
 
+def open_connection(addr, timeout: float) -> socket.socket:
+    """
+    Like socket.create_connection(), but sets the socket options before
+    connect() so the buffer sizes are in place for the TCP handshake.
+    """
+    err = None
+    for family, type_, proto, _, sockaddr in socket.getaddrinfo(addr[0], addr[1], type=socket.SOCK_STREAM):
+        sock = socket.socket(family, type_, proto)
+        try:
+            # ENQ/ACK/EOT are single-byte writes: do not let Nagle hold them back
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_BUF_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_BUF_SIZE)
+            sock.settimeout(timeout)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            err = e
+            sock.close()
+    raise err if err else OSError(f"No address found for {addr[0]}")
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(
         description="Simulate a Sysmex analyzer sending a LAB-29 ASTM result to LabBook Connect."
@@ -258,6 +436,11 @@ def main() -> None:
         action="store_true",
         help="Do not wait for ASTM response from plugin.",
     )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Send all frames before reading their ACKs (a NAK aborts the message). For benchmarks.",
+    )
 
     args = parser.parse_args()
 
@@ -272,10 +455,11 @@ def main() -> None:
     addr = (args.host, args.port)
     print(f"\nConnecting to {addr[0]}:{addr[1]} as Sysmex client...")
     try:
-        with socket.create_connection(addr, timeout=10.0) as sock:
-            send_astm_message(sock, astm_message)
+        with open_connection(addr, timeout=10.0) as sock:
+            reader = FramedReader(sock)
+            send_astm_message(sock, reader, astm_message, pipeline=args.pipeline)
             if not args.no_response:
-                response = receive_astm_from_plugin(sock)
+                response = receive_astm_from_plugin(sock, reader)
             else:
                 response = ""
     except Exception as e:
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 """
 ASTM E1381 minimal server for Sysmex.
-- Listens on a TCP port
+- Listens on a TCP port, one thread per connected analyzer
 - Implements ENQ/ACK handshakes, frame ACK/NAK, and EOT handling
 - Verifies 2-hex checksum (sum of bytes between STX and ETX/ETB, including frame number)
 - Logs hex + ASCII + protocol events to a rotating log file
@@ -22,6 +22,7 @@ import logging
 import logging.handlers
 import socket
 import sys
+import threading
 import time
 from datetime import datetime
 
@@ -38,45 +39,112 @@ LF  = 0x0A
 
 READ_TIMEOUT_S = 15.0   # timeout socket read
 IDLE_TIMEOUT_S = 120.0  # end of session if nothing happens
+SOCK_BUF_SIZE = 262144  # SO_RCVBUF / SO_SNDBUF
+
+# serializes writes to the shared --capture file across client threads
+_capture_lock = threading.Lock()
+
+# translate() table for the ASCII column of hexdump: non printable bytes -> '.'
+_PRINTABLE = bytes(c if 32 <= c <= 126 else ord(".") for c in range(256))
 
 def hexdump(b: bytes, width: int = 16) -> str:
     lines = []
     for i in range(0, len(b), width):
         chunk = b[i:i+width]
-        hexs = " ".join(f"{x:02X}" for x in chunk)
-        text = "".join(chr(x) if 32 <= x <= 126 else "." for x in chunk)
+        hexs = chunk.hex(" ").upper()
+        text = chunk.translate(_PRINTABLE).decode("ascii")
         lines.append(f"{i:04X}  {hexs:<{width*3}}  {text}")
     return "\n".join(lines)
 
-def calc_checksum(frame_bytes: bytes) -> int:
+# Two ASCII hex digits (indexed as hi << 8 | lo) -> checksum value, -1 if not hex
+_HEX_TABLE = [-1] * 65536
+for _hi in b"0123456789ABCDEFabcdef":
+    for _lo in b"0123456789ABCDEFabcdef":
+        _HEX_TABLE[_hi << 8 | _lo] = int(bytes([_hi, _lo]), 16)
+del _hi, _lo
+
+def calc_checksum(frame_bytes) -> int:
     """
     ASTM checksum = low 8 bits of sum of all bytes from (and including) the
     frame number up to (and including) ETX/ETB. STX is excluded.
+    Accepts any bytes-like object; a memoryview avoids copying a bytearray.
+    """
+    return sum(memoryview(frame_bytes)) & 0xFF
+
+class FramedReader:
+    """
+    Buffered reader on top of a socket.
+    One large recv() refills an in-memory buffer; single bytes, fixed-size
+    trailers and delimited frame bodies are then served from that buffer.
     """
-    return sum(frame_bytes) & 0xFF
-
-def read_exact(sock: socket.socket, n: int) -> bytes:
-    buf = bytearray()
-    while len(buf) < n:
-        chunk = sock.recv(n - len(buf))
-        if not chunk:
-            break
-        buf.extend(chunk)
-    return bytes(buf)
-
-def recv_until(sock: socket.socket, stop_bytes: set, max_len: int = 8192) -> bytes:
+
+    def __init__(self, sock: socket.socket, bufsize: int = 4096):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.buf = bytearray()
+        self.pos = 0
+        # preallocated landing zone for recv_into(), reused by every refill
+        self._chunk = memoryview(bytearray(bufsize))
+
+    def _fill(self) -> bool:
+        """Append more data from the socket to the buffer. Returns False on EOF."""
+        k = self.sock.recv_into(self._chunk)
+        if not k:
+            return False
+        if self.pos:
+            # drop already consumed bytes before growing the buffer
+            del self.buf[:self.pos]
+            self.pos = 0
+        self.buf += self._chunk[:k]
+        return True
+
+    def read_byte(self) -> int:
+        """Return the next byte value, or -1 if the peer closed the connection."""
+        if self.pos >= len(self.buf) and not self._fill():
+            return -1
+        byte = self.buf[self.pos]
+        self.pos += 1
+        return byte
+
+    def read_exact(self, n: int) -> bytes:
+        """Read n bytes (fewer only if the peer closed the connection)."""
+        while len(self.buf) - self.pos < n:
+            if not self._fill():
+                break
+        with memoryview(self.buf) as view:
+            data = bytes(view[self.pos:self.pos + n])
+        self.pos += len(data)
+        return data
+
+    def read_until(self, stop_bytes: set, max_len: int = 8192) -> bytes:
+        """
+        Read bytes until one of stop bytes encountered or max_len exceeded.
+        Returns the data INCLUDING the stop byte.
+        """
+        scanned = 0  # bytes after pos already searched, not rescanned after a refill
+        while True:
+            limit = min(len(self.buf), self.pos + max_len)
+            hits = [i for i in (self.buf.find(s, self.pos + scanned, limit) for s in stop_bytes) if i >= 0]
+            if hits:
+                end = min(hits) + 1
+            elif limit - self.pos >= max_len:
+                end = limit
+            else:
+                scanned = limit - self.pos
+                if self._fill():
+                    continue
+                end = len(self.buf)
+            with memoryview(self.buf) as view:
+                data = bytes(view[self.pos:end])
+            self.pos = end
+            return data
+
+def tune_session_socket(conn: socket.socket):
     """
-    Read bytes until one of stop bytes encountered or max_len exceeded.
-    Returns the data INCLUDING the stop byte.
+    Low-latency options for an accepted ASTM session: the exchange is made of
+    single-byte ENQ/ACK/NAK/EOT replies, which Nagle would hold back.
     """
-    buf = bytearray()
-    while True:
-        b = sock.recv(1)
-        if not b:
-            return bytes(buf)
-        buf.extend(b)
-        if b[0] in stop_bytes or len(buf) >= max_len:
-            return bytes(buf)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
 def setup_logger(log_path: str) -> logging.Logger:
     logger = logging.getLogger("astm_server")
@@ -84,7 +152,7 @@ def setup_logger(log_path: str) -> logging.Logger:
     handler = logging.handlers.RotatingFileHandler(
             log_path, maxBytes=5_000_000, backupCount=3, encoding="utf-8"
             )
-    fmt = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
+    fmt = logging.Formatter("%(asctime)s | %(levelname)s | %(threadName)s | %(message)s")
     handler.setFormatter(fmt)
     logger.addHandler(handler)
 
@@ -96,11 +164,29 @@ def setup_logger(log_path: str) -> logging.Logger:
 
     return logger
 
-def dump_full_message(logger: logging.Logger, full_message: bytearray, capture_fh):
+def write_capture(capture_fh, *chunks: bytes, flush: bool = False):
+    """
+    Append chunks to the capture file as one unit: the chunks of a single
+    call stay together, but records of concurrent sessions can still
+    alternate between calls. No-op without --capture.
+    """
+    if not capture_fh:
+        return
+    with _capture_lock:
+        if capture_fh.closed:
+            return
+        for chunk in chunks:
+            capture_fh.write(chunk)
+        if flush:
+            capture_fh.flush()
+
+def dump_full_message(logger: logging.Logger, segments: list, capture_fh):
     """
     After EOT / session end, dump the full reconstructed ASTM message in readable ASCII,
     and also persist it to --capture if requested.
+    segments are the payloads of the accepted frames, joined only here.
     """
+    full_message = b"".join(segments)
     try:
         ascii_msg = full_message.decode("ascii", errors="replace")
     except Exception:
@@ -108,22 +194,25 @@ def dump_full_message(logger: logging.Logger, full_message: bytearray, capture_f
 
     logger.info("===== MESSAGE ASTM COMPLET (début) =====")
     # For readability in logs: show each CR as newline
-    logger.info(ascii_msg.replace("\r", "\r\n"))
+    logger.info("%s", ascii_msg.replace("\r", "\r\n"))
     logger.info("===== MESSAGE ASTM COMPLET (fin) =====")
 
-    if capture_fh:
-        capture_fh.write(b"\n##### NEW MESSAGE #####\n")
-        capture_fh.write(full_message)
-        capture_fh.write(b"\n##### END MESSAGE #####\n")
-        capture_fh.flush()
+    write_capture(
+            capture_fh,
+            b"\n##### NEW MESSAGE #####\n",
+            full_message,
+            b"\n##### END MESSAGE #####\n",
+            flush=True,
+            )
 
 def handle_client(conn: socket.socket, addr, logger: logging.Logger, capture_fh):
-    # buffer to reconstruct the full ASTM message across multiple frames
-    full_message = bytearray()
+    # payloads of accepted frames, joined into the full ASTM message on dump
+    segments = []
 
     conn.settimeout(READ_TIMEOUT_S)
+    reader = FramedReader(conn)
     peer = f"{addr[0]}:{addr[1]}"
-    logger.info(f"Client connected: {peer}")
+    logger.info("Client connected: %s", peer)
 
     last_activity = time.time()
     try:
@@ -132,23 +221,22 @@ def handle_client(conn: socket.socket, addr, logger: logging.Logger, capture_fh)
             if time.time() - last_activity > IDLE_TIMEOUT_S:
                 logger.info("Idle timeout reached; closing session.")
                 # dump whatever we got so far (might be partial)
-                dump_full_message(logger, full_message, capture_fh)
+                dump_full_message(logger, segments, capture_fh)
                 return
 
             # Read one byte (expect ENQ, or EOT if remote aborts)
             try:
-                b = conn.recv(1)
+                byte = reader.read_byte()
             except socket.timeout:
                 continue
 
-            if not b:
+            if byte < 0:
                 logger.info("Connection closed by peer.")
                 # dump partial message before exit
-                dump_full_message(logger, full_message, capture_fh)
+                dump_full_message(logger, segments, capture_fh)
                 return
 
             last_activity = time.time()
-            byte = b[0]
 
             if byte == ENQ:
                 logger.info("<<< ENQ received — sending ACK")
@@ -158,92 +246,81 @@ def handle_client(conn: socket.socket, addr, logger: logging.Logger, capture_fh)
             if byte == EOT:
                 logger.info("<<< EOT received — session complete")
                 # here is where we dump the full reconstructed ASTM message
-                dump_full_message(logger, full_message, capture_fh)
+                dump_full_message(logger, segments, capture_fh)
                 return
 
             if byte == STX:
                 # Read one ASTM frame:
                 # STX already read; now read until ETX or ETB is included.
                 # Format: STX <frame-no> <text> <ETX|ETB> <cksum(2 hex chars)> <CR> <LF>
-                frame = bytearray()
-                # we will build the checksum input (from frame-no up to ETX/ETB)
-                checksum_input = bytearray()
-
                 # first byte after STX is the frame number
-                frame_no_b = conn.recv(1)
-                if not frame_no_b:
+                frame_no = reader.read_byte()
+                if frame_no < 0:
                     logger.warning("Frame aborted: no frame number.")
                     # dump and bail, so we don't lose what we had
-                    dump_full_message(logger, full_message, capture_fh)
+                    dump_full_message(logger, segments, capture_fh)
                     return
-                frame.extend(frame_no_b)
-                checksum_input.extend(frame_no_b)
 
-                # then read until ETX or ETB
-                data = recv_until(conn, {ETX, ETB})
+                # then read until ETX or ETB; data = <text> <ETX|ETB>, the only copy of the frame body
+                data = reader.read_until({ETX, ETB})
                 if not data or data[-1] not in (ETX, ETB):
                     logger.warning("Frame aborted: ETX/ETB not found.")
-                    dump_full_message(logger, full_message, capture_fh)
+                    dump_full_message(logger, segments, capture_fh)
                     return
-                frame.extend(data)
-                checksum_input.extend(data)
 
                 # read checksum (2 ASCII hex)
-                cks = read_exact(conn, 2)
+                cks = reader.read_exact(2)
                 if len(cks) != 2:
                     logger.warning("Frame aborted: missing 2-digit checksum.")
-                    dump_full_message(logger, full_message, capture_fh)
+                    dump_full_message(logger, segments, capture_fh)
                     return
 
                 # read CR LF
-                crlf = read_exact(conn, 2)
+                crlf = reader.read_exact(2)
                 if len(crlf) != 2 or crlf[0] != CR or crlf[1] != LF:
-                    logger.warning(f"Frame aborted: missing CRLF (got {crlf!r}).")
-                    dump_full_message(logger, full_message, capture_fh)
+                    logger.warning("Frame aborted: missing CRLF (got %r).", crlf)
+                    dump_full_message(logger, segments, capture_fh)
                     return
 
-                # full frame (for debug hex dump)
-                full = bytes([STX]) + bytes(frame) + cks + crlf
-                logger.debug("<<< Received frame\n" + hexdump(full))
+                # full frame (for debug hex dump), only rebuilt when DEBUG is on
+                if logger.isEnabledFor(logging.DEBUG):
+                    full = bytes([STX, frame_no]) + data + cks + crlf
+                    logger.debug("<<< Received frame\n%s", hexdump(full))
 
-                # verify checksum
-                calc = calc_checksum(bytes(checksum_input))
-                try:
-                    recv_ck = int(cks.decode("ascii"), 16)
-                except Exception:
-                    recv_ck = -1
+                # verify checksum (from frame-no up to ETX/ETB)
+                calc = (frame_no + calc_checksum(data)) & 0xFF
+                recv_ck = _HEX_TABLE[cks[0] << 8 | cks[1]]
                 ok = (recv_ck == calc)
 
-                # extract payload = text between frame-no and ETX/ETB (exclude frame-no byte and terminator)
-                payload = bytes(frame[1:-1])
-
-                # prepare human-readable payload for logs
-                safe = payload.decode("ascii", errors="replace")
+                # extract payload = text between frame-no and ETX/ETB (exclude frame-no byte and terminator),
+                # as a view on data rather than another copy
+                payload = memoryview(data)[:-1]
+                ends_with_cr = len(payload) > 0 and payload[-1] == CR
 
                 # frame number pretty print
-                frame_no_val = frame[0]
-                frame_no_disp = chr(frame_no_val) if 32 <= frame_no_val <= 126 else frame_no_val
+                frame_no_disp = chr(frame_no) if 32 <= frame_no <= 126 else frame_no
                 logger.info(
-                    f"Frame #{frame_no_disp} "
-                    f"len={len(payload)} checksum=recv:{recv_ck:02X} calc:{calc:02X} "
-                    f"status={'OK' if ok else 'BAD'}"
+                    "Frame #%s len=%d checksum=recv:%02X calc:%02X status=%s",
+                    frame_no_disp, len(payload), recv_ck, calc, "OK" if ok else "BAD",
                 )
-                logger.debug(f"Payload (ASCII): {safe}")
-
-                # append to capture file (raw ASTM records, with CR at end)
-                if capture_fh:
-                    if payload.endswith(b"\r"):
-                        capture_fh.write(payload)
-                    else:
-                        capture_fh.write(payload + b"\r")
-                    capture_fh.flush()
+                if logger.isEnabledFor(logging.DEBUG):
+                    # human-readable payload for logs
+                    safe = str(payload, "ascii", errors="replace")
+                    logger.debug("Payload (ASCII): %s", safe)
+
+                # append to capture file (raw ASTM records, with CR at end);
+                # buffered, flushed along with the full message in dump_full_message
+                if ends_with_cr:
+                    write_capture(capture_fh, payload)
+                else:
+                    write_capture(capture_fh, payload, b"\r")
 
                 # append to reconstructed full message if checksum is OK
                 if ok:
-                    full_message.extend(payload)
+                    segments.append(payload)
                     # optional safety: ensure CR separator if frame didn't end with CR
-                    if not payload.endswith(b"\r"):
-                        full_message.extend(b"\r")
+                    if not ends_with_cr:
+                        segments.append(b"\r")
 
                 # ACK/NAK frame
                 if ok:
@@ -263,20 +340,21 @@ def handle_client(conn: socket.socket, addr, logger: logging.Logger, capture_fh)
                 continue
 
             # Any other control—log and continue
-            logger.debug(f"<<< Unexpected byte 0x{byte:02X}; ignoring")
+            logger.debug("<<< Unexpected byte 0x%02X; ignoring", byte)
 
     except socket.timeout:
         logger.info("Socket timeout; closing session.")
-        dump_full_message(logger, full_message, capture_fh)
+        dump_full_message(logger, segments, capture_fh)
     except Exception as e:
-        logger.exception(f"Error during client handling: {e}")
-        dump_full_message(logger, full_message, capture_fh)
+        logger.exception("Error during client handling: %s", e)
+        dump_full_message(logger, segments, capture_fh)
     finally:
         try:
             conn.close()
         except Exception:
             pass
-        logger.info(f"Client disconnected: {peer}")
+        # per-connection completion (the accept loop no longer waits for sessions)
+        logger.info("Client disconnected: %s", peer)
 
 def main():
     parser = argparse.ArgumentParser(description="ASTM E1381 server (Sysmex capture).")
@@ -288,28 +366,38 @@ def main():
 
     log_path = args.log or f"astm_server_{datetime.now().strftime('%Y%m%d')}.log"
     logger = setup_logger(log_path)
-    logger.info(f"Starting ASTM server on {args.host}:{args.port}")
+    logger.info("Starting ASTM server on %s:%s", args.host, args.port)
 
     capture_fh = None
     try:
         if args.capture:
-            capture_fh = open(args.capture, "ab", buffering=0)
-            logger.info(f"Capturing payload to: {args.capture}")
+            capture_fh = open(args.capture, "ab")
+            logger.info("Capturing payload to: %s", args.capture)
 
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # set before listen() so accepted sockets inherit them
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_BUF_SIZE)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_BUF_SIZE)
             s.bind((args.host, args.port))
             s.listen(5)
             logger.info("Waiting for connections...")
             while True:
                 conn, addr = s.accept()
-                handle_client(conn, addr, logger, capture_fh)
-                logger.info("Ready for next connection.")
+                tune_session_socket(conn)
+                # one thread per analyzer so a slow session does not block the others
+                threading.Thread(
+                        target=handle_client,
+                        args=(conn, addr, logger, capture_fh),
+                        name=f"client-{addr[0]}:{addr[1]}",
+                        daemon=True,
+                        ).start()
     except KeyboardInterrupt:
         logger.info("Interrupted by user.")
     finally:
         if capture_fh:
-            capture_fh.close()
+            with _capture_lock:
+                capture_fh.close()
         logger.info("Server stopped.")
 
 if __name__ == "__main__":